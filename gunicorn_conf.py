@@ -0,0 +1,29 @@
+"""
+Gunicorn configuration for the UniFi PoE Webhook Server
+
+Usage: gunicorn -c gunicorn_conf.py unifi_webhook_server:app
+"""
+
+import json
+
+# Listen on webhook.host/webhook.port from config.json, as the standalone server does
+try:
+    with open("config.json", 'r') as f:
+        webhook = json.load(f).get("webhook", {})
+except FileNotFoundError:
+    webhook = {}
+
+bind = f"{webhook.get('host', '0.0.0.0')}:{webhook.get('port', 5000)}"
+
+# Webhook handlers spend nearly all their time waiting on the UniFi API,
+# so gevent greenlets give concurrency without extra processes.
+worker_class = "gevent"
+worker_connections = 1000
+
+# Rate limiting and the operation queue live in process memory; a second
+# worker would keep its own copy and let requests bypass the cooldowns.
+workers = 1
+
+accesslog = "-"
+errorlog = "-"
+loglevel = "info"
@@ -4,33 +4,93 @@ UniFi PoE Webhook Power Management Server
 Provides webhook endpoints to control Raspberry Pi power via UniFi PoE ports
 """
 
+# Patch blocking stdlib calls before anything imports sockets or threading,
+# so UniFi API calls and queue delays yield to other greenlets
+from gevent import monkey
+monkey.patch_all()
+
+import heapq
+import hmac
+import http.client
 import json
 import time
-import requests
 import logging
+import math
 import os
+import socket
+import ssl
 import subprocess
 import threading
-from flask import Flask, request, jsonify
-from datetime import datetime
+import orjson
+from flask import Flask, request
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
 from typing import Dict, List, Optional
-import urllib3
+from urllib.parse import urlsplit
 from dotenv import load_dotenv
-from queue import Queue
+from gevent.pywsgi import WSGIServer
 
 # Load environment variables
 load_dotenv()
 
-# Disable SSL warnings for self-signed certificates
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+# (epoch second, formatted timestamp) reused until the second rolls over
+_timestamp_cache = (0, "")
+
+def _now_iso() -> str:
+    """Return the current UTC time as an ISO 8601 string, formatted at most once per second"""
+    global _timestamp_cache
+    now = int(time.time())
+    cached_sec, cached_str = _timestamp_cache
+    if now != cached_sec:
+        cached_str = datetime.fromtimestamp(now, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        _timestamp_cache = (now, cached_str)
+    return cached_str
+
+# Config sections are frozen; slots=True is left out because it needs Python 3.10
+@dataclass(frozen=True)
+class UnifiCfg:
+    """UniFi controller API settings"""
+    api_key: str = field(repr=False)
+    base_url: str
+    site_id: str
+    device_id: str
+
+@dataclass(frozen=True)
+class WebhookCfg:
+    """Webhook server settings"""
+    host: str
+    port: int
+    auth_token: Optional[str] = field(repr=False)
+    power_cycle_delay: int
 
 class UniFiConfig:
     """Configuration class for UniFi API settings"""
     def __init__(self, config_file: str = "config.json"):
-        self.config = self.load_config(config_file)
+        self.load_config(config_file)
         
-    def load_config(self, config_file: str) -> dict:
-        """Load configuration from JSON file"""
+    def load_config(self, config_file: str):
+        """Load configuration from JSON file, resolving environment overrides once"""
+        raw = self._read_config_file(config_file)
+        unifi = raw["unifi"]
+        webhook = raw["webhook"]
+        
+        self.unifi = UnifiCfg(
+            api_key=os.getenv("UNIFI_API_KEY") or unifi["api_key"],
+            base_url=os.getenv("UNIFI_BASE_URL") or unifi["base_url"],
+            site_id=os.getenv("UNIFI_SITE_ID") or unifi["site_id"],
+            device_id=os.getenv("UNIFI_DEVICE_ID") or unifi["device_id"]
+        )
+        # Port entries are passed through as-is so /ports reports every configured key
+        self.ports: Dict[str, dict] = raw["ports"]
+        self.webhook = WebhookCfg(
+            host=webhook.get("host", "0.0.0.0"),
+            port=webhook.get("port", 5000),
+            auth_token=os.getenv("WEBHOOK_AUTH_TOKEN") or webhook.get("auth_token"),
+            power_cycle_delay=webhook.get("power_cycle_delay", 3)
+        )
+    
+    def _read_config_file(self, config_file: str) -> dict:
+        """Read the raw JSON config, creating a default file if missing"""
         try:
             with open(config_file, 'r') as f:
                 return json.load(f)
@@ -61,143 +121,167 @@ class UniFiConfig:
                 json.dump(default_config, f, indent=2)
             print(f"Created default config file: {config_file}")
             return default_config
+
+class TokenBucket:
+    """Token bucket allowing bursts of up to cap operations, refilled at rate tokens per second"""
+    __slots__ = ("tokens", "last", "rate", "cap")
+    
+    def __init__(self, cap: float, rate: float):
+        self.cap = cap
+        self.rate = rate
+        self.tokens = cap
+        self.last = time.monotonic()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.cap, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+    
+    def take(self, cost: float = 1.0) -> bool:
+        """Consume cost tokens if available"""
+        self._refill()
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return True
+        return False
     
-    @property
-    def api_key(self) -> str:
-        return os.getenv("UNIFI_API_KEY") or self.config["unifi"]["api_key"]
-    
-    @property
-    def base_url(self) -> str:
-        return os.getenv("UNIFI_BASE_URL") or self.config["unifi"]["base_url"]
-    
-    @property
-    def site_id(self) -> str:
-        return os.getenv("UNIFI_SITE_ID") or self.config["unifi"]["site_id"]
-    
-    @property
-    def device_id(self) -> str:
-        return os.getenv("UNIFI_DEVICE_ID") or self.config["unifi"]["device_id"]
-    
-    @property
-    def ports(self) -> dict:
-        return self.config["ports"]
-    
-    @property
-    def webhook_config(self) -> dict:
-        return self.config["webhook"]
+    def seconds_until(self, cost: float = 1.0) -> float:
+        """Seconds until cost tokens will be available"""
+        self._refill()
+        return max(0.0, (cost - self.tokens) / self.rate)
 
 class UniFiPortController:
     """Controller for UniFi PoE port operations"""
     
     def __init__(self, config: UniFiConfig):
         self.config = config
-        self.session = requests.Session()
-        self.session.verify = False  # Disable SSL verification for self-signed certs
-        self.last_operation_time = {}  # Track last operation time per port per operation type
-        self.rate_limit_seconds = 30  # Cooldown period in seconds
-        self.operation_queue = Queue()  # Queue for delayed operations
-        self.last_unifi_operation = {}  # Track last UniFi API call per port
-        self.unifi_cooldown = 10  # Seconds to wait between UniFi operations on same port
-        self._start_queue_worker()
+        unifi = config.unifi
         
-    def _make_request(self, method: str, endpoint: str, data: dict = None) -> requests.Response:
-        """Make authenticated request to UniFi API"""
-        url = f"{self.config.base_url}/{endpoint}"
-        headers = {
-            'X-API-KEY': self.config.api_key,
+        # Pool of keep-alive connections, one in use per concurrent UniFi call
+        url = urlsplit(unifi.base_url)
+        self._conn_host = url.hostname
+        self._conn_port = url.port
+        self._ssl_context = None
+        if url.scheme == "https":
+            self._ssl_context = ssl.create_default_context()
+            self._ssl_context.check_hostname = False
+            self._ssl_context.verify_mode = ssl.CERT_NONE  # Disable SSL verification for self-signed certs
+        self.connect_timeout = 3.05  # Seconds to establish a connection
+        self.read_timeout = 10  # Seconds to wait on a connected socket
+        self._idle_conns = []  # Idle connections, reused most-recent first
+        self._conns_lock = threading.Lock()
+        self._max_idle_conns = max(1, len(config.ports))
+        self._ports_path_prefix = f"{url.path.rstrip('/')}/sites/{unifi.site_id}/devices/{unifi.device_id}/interfaces/ports"
+        self._cycle_body_bytes = b'{"action":"POWER_CYCLE"}'
+        self._headers = {
+            'X-API-KEY': unifi.api_key,
             'Content-Type': 'application/json',
             'Accept': 'application/json'
         }
+        self.rate_limit_burst = 3  # Power actions a port may take back to back
+        self.rate_limit_seconds = 30  # Seconds to earn back one action
+        self._buckets = {
+            int(p): TokenBucket(cap=self.rate_limit_burst, rate=1 / self.rate_limit_seconds)
+            for p in config.ports
+        }
+        # Single lock for all mutable controller state, shared with the worker's condition
+        self._state_lock = threading.Lock()
+        self._heap = []  # Queued operations as (monotonic execute_at, port, action)
+        self._cv = threading.Condition(self._state_lock)  # Wakes the worker on new operations
+        self._pending = set()  # (port, action) pairs currently queued
+        self.max_queued_operations = 64
+        self.unifi_ready_at = {}  # Monotonic time of each port's next unreserved UniFi slot
+        self._in_flight = set()  # Ports with a UniFi call currently running
+        self._deferred = {}  # Actions that came due while their port's call was running
+        self._port_free_at = {}  # Monotonic time each port's last call finished plus the cooldown
+        self.unifi_cooldown = 10  # Seconds to wait between UniFi operations on same port
+        self.port_state: Dict[int, str] = {}  # "running" or "stopped" per port, from the last on/off
+        self._start_queue_worker()
         
-        if method.upper() == 'POST':
-            return self.session.post(url, headers=headers, json=data)
-        elif method.upper() == 'GET':
-            return self.session.get(url, headers=headers)
-        else:
-            raise ValueError(f"Unsupported method: {method}")
-    
     def _start_queue_worker(self):
-        """Start background thread to process queued operations"""
+        """Start background thread to run queued operations in deadline order"""
         def queue_worker():
             while True:
-                try:
-                    # Get next queued operation (blocks until available)
-                    operation_data = self.operation_queue.get()
-                    if operation_data is None:  # Shutdown signal
-                        break
-                    
-                    port = operation_data['port']
-                    action = operation_data['action']
-                    delay = operation_data['delay']
+                with self._cv:
+                    if not self._heap:
+                        self._cv.wait()
+                        continue
                     
-                    # Wait for the specified delay
-                    time.sleep(delay)
+                    # Sleep until the soonest operation is due, or a sooner one arrives
+                    execute_at, port, action = self._heap[0]
+                    wait = execute_at - time.monotonic()
+                    if wait > 0:
+                        self._cv.wait(timeout=wait)
+                        continue
+                    heapq.heappop(self._heap)
                     
-                    # Execute the operation
-                    logger.info(f"Executing queued {action} operation for port {port}")
-                    result = self._execute_power_cycle(port, action)
-                    
-                    if result["success"]:
-                        self.last_unifi_operation[port] = time.time()
-                        logger.info(f"Queued {action} operation for port {port} completed successfully")
-                    else:
-                        logger.warning(f"Queued {action} operation for port {port} failed: {result.get('error', 'Unknown error')}")
-                    
-                    self.operation_queue.task_done()
-                    
-                except Exception as e:
-                    logger.error(f"Error in queue worker: {e}")
-                    self.operation_queue.task_done()
+                    # Calls to the same port never overlap and stay a cooldown apart,
+                    # measured from when the previous call finished
+                    if port in self._in_flight:
+                        self._deferred.setdefault(port, []).append(action)
+                        continue
+                    free_at = self._port_free_at.get(port, 0)
+                    if free_at > time.monotonic():
+                        heapq.heappush(self._heap, (free_at, port, action))
+                        continue
+                    self._in_flight.add(port)
+                
+                # Run each due operation on its own greenlet (thread without gevent)
+                # so a slow UniFi response doesn't hold up other ports
+                threading.Thread(target=self._run_queued_operation, args=(port, action), daemon=True).start()
         
         # Start worker thread
         worker_thread = threading.Thread(target=queue_worker, daemon=True)
         worker_thread.start()
     
-    def _can_execute_immediately(self, port: int) -> bool:
-        """Check if we can execute UniFi operation immediately"""
-        if port not in self.last_unifi_operation:
-            return True
-        
-        time_since_last = time.time() - self.last_unifi_operation[port]
-        return time_since_last >= self.unifi_cooldown
-    
-    def _get_operation_key(self, port: int, operation: str) -> str:
-        """Generate unique key for port + operation combination"""
-        return f"{port}:{operation}"
-    
-    def _is_port_operation_rate_limited(self, port: int, operation: str) -> bool:
-        """Check if specific port + operation is currently rate limited"""
-        key = self._get_operation_key(port, operation)
-        if key not in self.last_operation_time:
-            return False
-        
-        time_since_last = time.time() - self.last_operation_time[key]
-        return time_since_last < self.rate_limit_seconds
-    
-    def _record_port_operation(self, port: int, operation: str):
-        """Record that a specific operation was performed on this port"""
-        key = self._get_operation_key(port, operation)
-        self.last_operation_time[key] = time.time()
+    def _run_queued_operation(self, port: int, action: str):
+        """Execute a queued operation once it is due"""
+        try:
+            logger.info("Executing queued %s operation for port %s", action, port)
+            result = self._execute_power_cycle(port, action)
+            
+            if result["success"]:
+                logger.info("Queued %s operation for port %s completed successfully", action, port)
+            else:
+                logger.warning("Queued %s operation for port %s failed: %s", action, port, result.get('error', 'Unknown error'))
+        except Exception as e:
+            logger.error("Error in queue worker: %s", e)
+        finally:
+            self._finish_operation(port, action)
+    
+    def _finish_operation(self, port: int, action: str):
+        """Release a finished operation and start the port's UniFi cooldown from now"""
+        with self._state_lock:
+            self._pending.discard((port, action))
+            self._in_flight.discard(port)
+            free_at = time.monotonic() + self.unifi_cooldown
+            self._port_free_at[port] = free_at
+            if free_at > self.unifi_ready_at.get(port, 0):
+                self.unifi_ready_at[port] = free_at
+            
+            # Requeue anything that came due during the call; the worker spaces them out
+            for deferred_action in self._deferred.pop(port, []):
+                heapq.heappush(self._heap, (free_at, port, deferred_action))
+            self._cv.notify()
     
     def _get_rate_limit_response(self, port: int, action: str) -> dict:
         """Return standardized rate limit response"""
-        key = self._get_operation_key(port, action)
-        time_remaining = self.rate_limit_seconds - (time.time() - self.last_operation_time.get(key, 0))
+        time_remaining = math.ceil(self._buckets[port].seconds_until())
         return {
             "success": False,
             "action": action,
             "port": port,
-            "error": f"Rate limited. Please wait {int(time_remaining)} seconds before next {action} operation",
+            "error": f"Rate limited. Please wait {time_remaining} seconds before next {action} operation",
             "rate_limited": True,
-            "retry_after": int(time_remaining),
-            "timestamp": datetime.now().isoformat()
+            "retry_after": time_remaining,
+            "timestamp": _now_iso()
         }
     
     def power_on_port(self, port: int) -> dict:
         """Power on a specific port (no-op since power cycle handles this)"""
         # No rate limiting for power_on since it's a no-op that doesn't call UniFi API
-        # Just record the operation for status logic tracking
-        self._record_port_operation(port, "power_on")
+        # Just record the state for status tracking
+        self.port_state[port] = "running"
         
         # Since UniFi only supports power cycle, and power cycle automatically
         # powers the device back on, we just return success without doing anything.
@@ -208,140 +292,188 @@ class UniFiPortController:
             "port": port,
             "status": "no_action_needed",
             "message": "Port will power on automatically after power cycle",
-            "timestamp": datetime.now().isoformat()
+            "timestamp": _now_iso()
         }
     
     def power_off_port(self, port: int) -> dict:
         """Power off a specific port (uses power cycle since UniFi only supports cycle)"""
-        # Check rate limiting for power_off specifically  
-        if self._is_port_operation_rate_limited(port, "power_off"):
-            return self._get_rate_limit_response(port, "power_off")
-        
-        # Record operation for rate limiting
-        self._record_port_operation(port, "power_off")
-        
-        # Check if we can execute immediately
-        if self._can_execute_immediately(port):
-            # Execute immediately
-            result = self._execute_power_cycle(port, "power_off")
-            if result["success"]:
-                self.last_unifi_operation[port] = time.time()
-            return result
-        else:
-            # Queue for later execution
-            delay = self.unifi_cooldown - (time.time() - self.last_unifi_operation.get(port, 0))
-            self.operation_queue.put({
-                'port': port,
-                'action': 'power_off',
-                'delay': max(0, delay)
-            })
-            
-            return {
-                "success": True,
-                "action": "power_off",
-                "port": port,
-                "status": "queued",
-                "queued_delay": max(0, delay),
-                "message": f"Operation queued for execution in {max(0, int(delay))} seconds",
-                "timestamp": datetime.now().isoformat()
-            }
+        return self._schedule(port, "power_off")
     
     def power_cycle_port(self, port: int) -> dict:
         """Power cycle a specific port"""
-        # Check rate limiting for power_cycle specifically
-        if self._is_port_operation_rate_limited(port, "power_cycle"):
-            return self._get_rate_limit_response(port, "power_cycle")
-        
-        # Record operation for rate limiting
-        self._record_port_operation(port, "power_cycle")
+        return self._schedule(port, "power_cycle")
+    
+    def _schedule(self, port: int, action: str) -> dict:
+        """Rate limit, then queue a power cycle on behalf of action"""
+        # The UniFi call always runs on the queue worker, so the request only
+        # waits for this in-memory bookkeeping. Check, record and reserve
+        # atomically so concurrent requests can't both pass the rate limit
+        # or both claim the same UniFi slot.
+        with self._state_lock:
+            # Collapse duplicates of an already queued operation
+            if (port, action) in self._pending:
+                return {
+                    "success": True,
+                    "action": action,
+                    "port": port,
+                    "status": "queued",
+                    "message": "Operation already queued",
+                    "timestamp": _now_iso()
+                }
+            if len(self._heap) >= self.max_queued_operations:
+                return {
+                    "success": False,
+                    "action": action,
+                    "port": port,
+                    "error": "Operation queue is full, try again later",
+                    "queue_full": True,
+                    "timestamp": _now_iso()
+                }
+            
+            # Rate limit per port; duplicates and rejected requests don't spend tokens
+            if not self._buckets[port].take():
+                return self._get_rate_limit_response(port, action)
+            
+            if action == "power_off":
+                self.port_state[port] = "stopped"
+            
+            # Reserve the next UniFi slot for this port
+            now = time.monotonic()
+            execute_at = max(now, self.unifi_ready_at.get(port, 0))
+            self.unifi_ready_at[port] = execute_at + self.unifi_cooldown
+            
+            heapq.heappush(self._heap, (execute_at, port, action))
+            self._pending.add((port, action))
+            self._cv.notify()
         
-        # Check if we can execute immediately
-        if self._can_execute_immediately(port):
-            # Execute immediately
-            result = self._execute_power_cycle(port, "power_cycle")
-            if result["success"]:
-                self.last_unifi_operation[port] = time.time()
-            return result
+        delay = execute_at - now
+        return {
+            "success": True,
+            "action": action,
+            "port": port,
+            "status": "queued",
+            "queued_delay": delay,
+            "message": f"Operation queued for execution in {int(delay)} seconds",
+            "timestamp": _now_iso()
+        }
+    
+    def _connect(self) -> http.client.HTTPConnection:
+        """Open a new connection to the controller with separate connect and read timeouts"""
+        if self._ssl_context:
+            conn = http.client.HTTPSConnection(
+                self._conn_host, self._conn_port, timeout=self.connect_timeout, context=self._ssl_context
+            )
         else:
-            # Queue for later execution
-            delay = self.unifi_cooldown - (time.time() - self.last_unifi_operation.get(port, 0))
-            self.operation_queue.put({
-                'port': port,
-                'action': 'power_cycle',
-                'delay': max(0, delay)
-            })
+            conn = http.client.HTTPConnection(self._conn_host, self._conn_port, timeout=self.connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(self.read_timeout)
+        return conn
+    
+    def _release_conn(self, conn: http.client.HTTPConnection):
+        """Return a connection to the idle pool, or close it if the pool is full"""
+        with self._conns_lock:
+            if len(self._idle_conns) < self._max_idle_conns:
+                self._idle_conns.append(conn)
+                return
+        conn.close()
+    
+    def _post_power_cycle(self, port: int) -> int:
+        """POST the power cycle action to the controller and return the HTTP status"""
+        path = f"{self._ports_path_prefix}/{port}/actions"
+        with self._conns_lock:
+            conn = self._idle_conns.pop() if self._idle_conns else None
+        
+        # The stale-socket reconnect and the 502/503 retry have separate budgets
+        reconnected = False
+        gateway_retried = False
+        while True:
+            reused = conn is not None
+            if conn is None:
+                conn = self._connect()
+            try:
+                conn.request("POST", path, self._cycle_body_bytes, self._headers)
+                response = conn.getresponse()
+                response.read()  # Drain the body so the connection can be reused
+            except (http.client.RemoteDisconnected, BrokenPipeError):
+                conn.close()
+                conn = None
+                # An idle keep-alive socket the controller had already closed;
+                # the action was never delivered, so send it once on a new connection
+                if reused and not reconnected:
+                    reconnected = True
+                    continue
+                raise
+            except Exception:
+                # The action may have been delivered; never resend it
+                conn.close()
+                raise
             
-            return {
-                "success": True,
-                "action": "power_cycle",
-                "port": port,
-                "status": "queued",
-                "queued_delay": max(0, delay),
-                "message": f"Operation queued for execution in {max(0, int(delay))} seconds",
-                "timestamp": datetime.now().isoformat()
-            }
+            if response.will_close:
+                conn.close()
+                conn = None
+            
+            # Bad gateway / unavailable mean the Network app never got the action.
+            # A 504 is not retried: the proxy may have timed out after delivering it.
+            if response.status in (502, 503) and not gateway_retried:
+                gateway_retried = True
+                time.sleep(0.3)
+                continue
+            
+            if conn is not None:
+                self._release_conn(conn)
+            return response.status
     
     def _execute_power_cycle(self, port: int, action: str) -> dict:
         """Execute the actual power cycle operation via UniFi API"""
-        endpoint = f"sites/{self.config.site_id}/devices/{self.config.device_id}/interfaces/ports/{port}/actions"
-        
         try:
-            response = self._make_request('POST', endpoint, {"action": "POWER_CYCLE"})
+            status = self._post_power_cycle(port)
             
-            if response.status_code == 200:
+            if status == 200:
                 return {
                     "success": True,
                     "action": action,
                     "port": port,
                     "status": "cycling",
-                    "timestamp": datetime.now().isoformat()
+                    "timestamp": _now_iso()
                 }
             else:
                 return {
                     "success": False,
                     "action": action,
                     "port": port,
-                    "error": f"HTTP {response.status_code}",
-                    "timestamp": datetime.now().isoformat()
+                    "error": f"HTTP {status}",
+                    "timestamp": _now_iso()
                 }
+        except socket.timeout as e:
+            return {
+                "success": False,
+                "action": action,
+                "port": port,
+                "error": "unifi_timeout",
+                "message": str(e),
+                "timestamp": _now_iso()
+            }
         except Exception as e:
             return {
                 "success": False,
                 "action": action,
                 "port": port,
                 "error": str(e),
-                "timestamp": datetime.now().isoformat()
+                "timestamp": _now_iso()
             }
     
     def get_port_status(self, port: int) -> dict:
         """Get the status of a specific port based on last operation"""
-        # Simple status logic based on last operation called
         # Default to running if no operations have been performed
-        status = "running"
-        
-        # Check if power_off was the last operation (which triggers power cycle)
-        power_off_key = f"{port}:power_off"
-        power_on_key = f"{port}:power_on"
-        
-        power_off_time = self.last_operation_time.get(power_off_key, 0)
-        power_on_time = self.last_operation_time.get(power_on_key, 0)
-        
-        if power_off_time > power_on_time:
-            # Power off was called more recently than power on
-            status = "stopped"
-        else:
-            # Power on was called more recently or no operations yet
-            status = "running"
+        status = self.port_state.get(port, "running")
         
         # Format for MAAS regex pattern: status.*:.*running
-        status_message = f"status: {status}"
-        
         return {
             "success": True,
             "port": port,
-            "status": status_message,
+            "status": f"status: {status}",
             "method": "operation_tracking",
-            "timestamp": datetime.now().isoformat()
+            "timestamp": _now_iso()
         }
 
 # Initialize Flask app
@@ -349,140 +481,119 @@ app = Flask(__name__)
 config = UniFiConfig()
 controller = UniFiPortController(config)
 
+# Auth and port configuration are fixed for the life of the process
+AUTH_TOKEN = (config.webhook.auth_token or "").encode()
+VALID_PORTS = frozenset(int(p) for p in config.ports)
+PORTS_JSON = orjson.dumps({
+    "ports": config.ports,
+    "webhook_endpoints": {
+        "power_on": "/power/on/<port>",
+        "power_off": "/power/off/<port>",
+        "power_cycle": "/power/cycle/<port>",
+        "status": "/power/status/<port>"
+    }
+})
+# Everything in the /health body except the trailing timestamp
+_HEALTH_PREFIX = (
+    b'{"status":"healthy","configured_ports":'
+    + orjson.dumps(list(config.ports.keys()))
+    + b',"timestamp":"'
+)
+
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+def _json(payload, status: int = 200, headers: dict = None):
+    """Build a JSON response serialized with orjson"""
+    response = app.response_class(orjson.dumps(payload), status=status, mimetype="application/json")
+    if headers:
+        response.headers.update(headers)
+    return response
 
 def authenticate_request():
     """Check if request has valid authentication token"""
-    auth_token = os.getenv("WEBHOOK_AUTH_TOKEN") or config.webhook_config.get("auth_token")
-    if not auth_token:
+    if not AUTH_TOKEN:
         return True  # No auth required if not configured
     
-    # Check for token in header
-    provided_token = request.headers.get('Authorization', '').replace('Bearer ', '')
-    
-    # Check for token in query params
-    if not provided_token:
-        provided_token = request.args.get('token', '')
-    
-    # Check for token in form data
-    if not provided_token:
-        provided_token = request.form.get('token', '')
+    # Check for token in header, then query params, then form data
+    header = request.headers.get('Authorization')
+    if header:
+        provided_token = header[7:] if header.startswith('Bearer ') else header
+    else:
+        provided_token = request.args.get('token') or request.form.get('token') or ''
     
-    return provided_token == auth_token
+    # Constant-time compare so response timing doesn't leak the token
+    return hmac.compare_digest(provided_token.encode(), AUTH_TOKEN)
 
 @app.before_request
 def before_request():
     """Authenticate all requests"""
     if not authenticate_request():
-        return jsonify({"error": "Invalid or missing authentication token"}), 401
+        return _json({"error": "Invalid or missing authentication token"}, 401)
 
-@app.route('/power/on/<int:port>', methods=['POST', 'GET'])
-def power_on(port: int):
-    """Power on a specific port"""
-    if str(port) not in config.ports:
-        return jsonify({"error": f"Port {port} not configured"}), 400
-    
-    result = controller.power_on_port(port)
-    
-    # Handle rate limiting with HTTP 429
-    if not result["success"] and result.get("rate_limited", False):
-        status_code = 429
-        response = jsonify(result)
-        response.headers['Retry-After'] = str(result.get("retry_after", 30))
-    else:
-        status_code = 200 if result["success"] else 500
-        response = jsonify(result)
-    
-    logger.info(f"Power ON request for port {port}: {result}")
-    return response, status_code
+POWER_ACTIONS = {
+    "on": controller.power_on_port,
+    "off": controller.power_off_port,
+    "cycle": controller.power_cycle_port
+}
 
-@app.route('/power/off/<int:port>', methods=['POST', 'GET'])
-def power_off(port: int):
-    """Power off a specific port"""
-    if str(port) not in config.ports:
-        return jsonify({"error": f"Port {port} not configured"}), 400
-    
-    result = controller.power_off_port(port)
-    
-    # Handle rate limiting with HTTP 429
-    if not result["success"] and result.get("rate_limited", False):
-        status_code = 429
-        response = jsonify(result)
-        response.headers['Retry-After'] = str(result.get("retry_after", 30))
-    else:
-        status_code = 200 if result["success"] else 500
-        response = jsonify(result)
+@app.route('/power/<any(on, off, cycle):action>/<int:port>', methods=['POST', 'GET'])
+def power_action(action: str, port: int):
+    """Power on, off or cycle a specific port"""
+    if port not in VALID_PORTS:
+        return _json({"error": f"Port {port} not configured"}, 400)
     
-    logger.info(f"Power OFF request for port {port}: {result}")
-    return response, status_code
-
-@app.route('/power/cycle/<int:port>', methods=['POST', 'GET'])
-def power_cycle(port: int):
-    """Power cycle a specific port"""
-    if str(port) not in config.ports:
-        return jsonify({"error": f"Port {port} not configured"}), 400
+    result = POWER_ACTIONS[action](port)
     
-    result = controller.power_cycle_port(port)
+    logger.info("Power %s request for port %s: %s", action.upper(), port, result)
     
     # Handle rate limiting with HTTP 429
     if not result["success"] and result.get("rate_limited", False):
-        status_code = 429
-        response = jsonify(result)
-        response.headers['Retry-After'] = str(result.get("retry_after", 30))
+        return _json(result, 429, {'Retry-After': str(result.get("retry_after", 30))})
+    elif result.get("queue_full", False):
+        return _json(result, 503)
+    elif result.get("status") == "queued":
+        # Accepted; the queue worker performs the UniFi call
+        return _json(result, 202)
     else:
-        status_code = 200 if result["success"] else 500
-        response = jsonify(result)
-    
-    logger.info(f"Power CYCLE request for port {port}: {result}")
-    return response, status_code
+        return _json(result, 200 if result["success"] else 500)
 
 @app.route('/power/status/<int:port>', methods=['GET'])
 def power_status(port: int):
     """Get power status of a specific port"""
-    if str(port) not in config.ports:
-        return jsonify({"error": f"Port {port} not configured"}), 400
+    if port not in VALID_PORTS:
+        return _json({"error": f"Port {port} not configured"}, 400)
     
     result = controller.get_port_status(port)
     status_code = 200 if result["success"] else 500
     
-    logger.info(f"Status request for port {port}: {result}")
+    logger.info("Status request for port %s: %s", port, result)
     
     # For MAAS integration, return just the status message if successful
     if result["success"] and "status" in result:
         return result["status"], status_code
     else:
-        return jsonify(result), status_code
+        return _json(result, status_code)
 
 @app.route('/ports', methods=['GET'])
 def list_ports():
     """List all configured ports"""
-    return jsonify({
-        "ports": config.ports,
-        "webhook_endpoints": {
-            "power_on": "/power/on/<port>",
-            "power_off": "/power/off/<port>",
-            "power_cycle": "/power/cycle/<port>",
-            "status": "/power/status/<port>"
-        }
-    })
+    return app.response_class(PORTS_JSON, mimetype="application/json")
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
-    return jsonify({
-        "status": "healthy",
-        "timestamp": datetime.now().isoformat(),
-        "configured_ports": list(config.ports.keys())
-    })
+    body = _HEALTH_PREFIX + _now_iso().encode() + b'"}'
+    return app.response_class(body, mimetype="application/json")
 
 if __name__ == '__main__':
-    webhook_config = config.webhook_config
+    webhook_config = config.webhook
     
     print("🚀 Starting UniFi PoE Webhook Server")
     print(f"📋 Configured ports: {list(config.ports.keys())}")
-    print(f"🔗 Server will run on http://{webhook_config['host']}:{webhook_config['port']}")
+    print(f"🔗 Server will run on http://{webhook_config.host}:{webhook_config.port}")
     print("\n📚 Available endpoints:")
     print(f"  POST /power/on/<port>     - Power on port")
     print(f"  POST /power/off/<port>    - Power off port") 
@@ -491,11 +602,9 @@ if __name__ == '__main__':
     print(f"  GET  /ports              - List configured ports")
     print(f"  GET  /health             - Health check")
     
-    if webhook_config.get("auth_token"):
+    if webhook_config.auth_token:
         print(f"\n🔐 Authentication required: Include token in header, query param, or form data")
     
-    app.run(
-        host=webhook_config['host'],
-        port=webhook_config['port'],
-        debug=True
-    )
+    # Standalone gevent server; production runs under
+    # gunicorn -c gunicorn_conf.py unifi_webhook_server:app
+    WSGIServer((webhook_config.host, webhook_config.port), app).serve_forever()